@@ -1,14 +1,14 @@
 import os
-import re
 import gspread
 import pandas as pd
 import json
 import google.generativeai as genai
 import streamlit as st
-from PIL import Image
+from PIL import Image, ImageOps
 from datetime import datetime
 import plotly.express as px
 import hashlib
+import hmac
 import base64
 from io import BytesIO
 from google.cloud import vision
@@ -18,6 +18,38 @@ from google.oauth2 import service_account # --- 程式碼變更處：引入 serv
 st.set_page_config(page_title="AI 發票記帳助理", page_icon="🔐", layout="wide")
 GOOGLE_SHEET_NAME = '我的AI記帳本'
 ADMIN_USERNAME = "jerry" # 設定管理員帳號名稱
+AVATAR_PLACEHOLDER_URL = "https://placehold.co/150x150/4A4A4A/FFFFFF?text=👤"
+OCR_MAX_SIZE = (1600, 1600) # 送去辨識前圖片的最大尺寸 (長邊)
+PREVIEW_MAX_SIZE = (1024, 1024) # 上傳預覽圖的最大尺寸
+MAX_BATCH_GET_RANGES = 200 # 儀表板一次 batch_get 的範圍上限，超過則改為整張讀取
+VISION_BATCH_SIZE = 16 # Vision API 單次批次請求的圖片上限
+GEMINI_BATCH_SIZE = 5 # 每次送給 Gemini 解析的發票張數，避免回傳的 JSON 超過輸出長度上限而被截斷
+INVOICE_SCHEMA = { # 要求 Gemini 以結構化 JSON 回傳的發票格式
+    "type": "OBJECT",
+    "properties": {
+        "receipt_index": {"type": "INTEGER"},
+        "invoice_date": {"type": "STRING", "nullable": True},
+        "items": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "品項": {"type": "STRING"},
+                    "數量": {"type": "INTEGER"},
+                    "類別": {"type": "STRING"},
+                    "金額": {"type": "INTEGER"},
+                },
+                "required": ["品項", "數量", "類別", "金額"],
+            },
+        },
+    },
+    "required": ["receipt_index", "invoice_date", "items"],
+}
+RECEIPTS_SCHEMA = { # 多張發票一次解析，每張發票對應 receipts 陣列中的一個物件
+    "type": "OBJECT",
+    "properties": {"receipts": {"type": "ARRAY", "items": INVOICE_SCHEMA}},
+    "required": ["receipts"],
+}
 
 # --- 2. AI 與 Google 服務核心函式 ---
 
@@ -42,106 +74,201 @@ def get_vision_client():
         credentials = service_account.Credentials.from_service_account_info(creds_json)
         return vision.ImageAnnotatorClient(credentials=credentials)
     except Exception as e:
-        st.error(f"Google Vision API 連線失敗: {e}")
-        return None
+        # 在快取函式中只拋出例外，由頁面統一顯示錯誤，也避免把失敗結果快取起來
+        raise Exception(f"Google Vision API 連線失敗: {e}") from e
 
 def configure_gemini():
-    """設定 Gemini API 金鑰"""
+    """設定 Gemini API 金鑰，失敗時拋出例外"""
     try:
         genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-        return True
     except KeyError:
-        st.error("找不到 Gemini API 金鑰，請確認您已在 .streamlit/secrets.toml 中設定好 GEMINI_API_KEY。")
-        return False
+        raise Exception("找不到 Gemini API 金鑰，請確認您已在 .streamlit/secrets.toml 中設定好 GEMINI_API_KEY。")
     except Exception as e:
-        st.error(f"Gemini API 金鑰設定失敗。錯誤訊息: {e}")
-        return False
-
-def analyze_invoice_with_vision(vision_client, image_content):
-    """(速度優化) 使用 Vision API 進行快速文字辨識 (OCR)"""
-    image = vision.Image(content=image_content)
-    response = vision_client.document_text_detection(image=image)
-    if response.error.message:
-        raise Exception(f'Vision API 發生錯誤: {response.error.message}')
-    return response.full_text_annotation.text
-
-def parse_with_gemini(raw_text):
-    """(專注思考) 使用 Gemini AI 解析純文字，不再處理圖片"""
-    if not configure_gemini():
-        return None
-    model = genai.GenerativeModel('gemini-1.5-flash')
+        raise Exception(f"Gemini API 金鑰設定失敗。錯誤訊息: {e}") from e
+
+class GeminiParseError(Exception):
+    """Gemini 回傳的內容無法解析時拋出，並附上原始回傳內容方便使用者檢查"""
+    def __init__(self, message, raw_response=None):
+        super().__init__(message)
+        self.raw_response = raw_response
+
+def prepare_image_for_ocr(image_content):
+    """(速度優化) 上傳前先縮小並轉成灰階 JPEG，減少傳輸量與 API 延遲"""
+    try:
+        img = Image.open(BytesIO(image_content))
+        img = ImageOps.exif_transpose(img).convert("L")
+        img.thumbnail(OCR_MAX_SIZE, Image.Resampling.LANCZOS)
+        buffered = BytesIO()
+        img.save(buffered, format="JPEG", quality=85)
+        return buffered.getvalue()
+    except Exception:
+        # 無法處理的圖片就直接送出原始內容，交給 Vision API 判斷
+        return image_content
+
+def make_preview(image):
+    """(速度優化) 產生縮小的 JPEG 預覽圖，避免把原始大圖整張傳到瀏覽器"""
+    preview = ImageOps.exif_transpose(image).convert("RGB")
+    preview.thumbnail(PREVIEW_MAX_SIZE, Image.Resampling.BILINEAR)
+    with BytesIO() as buffered:
+        preview.save(buffered, format="JPEG", quality=80)
+        return buffered.getvalue()
+
+def analyze_invoices_with_vision(vision_client, image_contents):
+    """(速度優化) 使用 Vision API 批次進行文字辨識 (OCR)，多張發票共用同一個請求"""
+    feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+    raw_texts = []
+    for start in range(0, len(image_contents), VISION_BATCH_SIZE):
+        requests = [
+            vision.AnnotateImageRequest(image=vision.Image(content=content), features=[feature])
+            for content in image_contents[start:start + VISION_BATCH_SIZE]
+        ]
+        batch_response = vision_client.batch_annotate_images(requests=requests)
+        for response in batch_response.responses:
+            if response.error.message:
+                raise Exception(f'Vision API 發生錯誤: {response.error.message}')
+            raw_texts.append(response.full_text_annotation.text)
+    return raw_texts
+
+@st.cache_resource
+def _gemini_model():
+    """建立 Gemini 模型，金鑰設定與模型物件每個行程只建立一次"""
+    # 設定失敗時 configure_gemini 會拋出例外，不會把失敗結果快取到行程結束
+    configure_gemini()
+    generation_config = genai.GenerationConfig(response_mime_type="application/json", response_schema=RECEIPTS_SCHEMA)
+    return genai.GenerativeModel('gemini-1.5-flash', generation_config=generation_config)
+
+def parse_with_gemini(raw_texts):
+    """(專注思考) 使用 Gemini AI 一次解析多張發票的純文字，回傳依發票順序排列的解析結果"""
+    model = _gemini_model()
     
     prompt_parts = [
-        "你是一位頂尖的發票分析師。",
-        "請分析以下的發票文字，並將其內容解析成一個單一的 JSON 物件。",
-        "這個 JSON 物件必須包含兩個鍵: 'invoice_date' 和 'items'。",
-        "1. 'invoice_date': 發票上的日期，格式必須是 'YYYY-MM-DD'。如果看到民國年，請轉換成西元年。如果找不到日期，則回傳 null。",
-        "2. 'items': 一個 JSON 陣列，包含所有消費品項。",
-        "   - 每一筆消費都是一個 JSON 物件，必須包含 '品項', '數量', '類別', '金額' 四個鍵。",
-        "   - 『數量』必須是整數，如果圖片中沒有明確數量，預設為 1。",
-        "   - 根據品項名稱，自動判斷其「類別」，例如：餐飲食品, 生活用品, 電腦/電子產品, 交通, 其他。",
-        "   - 如果品項名稱有多行，請將它們合併成一個字串。",
-        "   - 如果遇到金額為 0 的品項，請直接忽略。",
-        "請只回傳這個單一的 JSON 物件，不要有其他任何文字說明。",
-        "範例格式: {\"invoice_date\": \"2023-03-18\", \"items\": [{\"品項\": \"範例品項\", \"數量\": 1, \"類別\": \"範例類別\", \"金額\": 100}]}",
-        "---",
-        "這是要分析的發票文字:",
-        "```text",
-        raw_text,
-        "```"
+        f"你是一位頂尖的發票分析師，請解析以下 {len(raw_texts)} 張發票的文字。",
+        "- 'receipts': 每張發票一個物件，'receipt_index' 為下方標示的發票編號。",
+        "- 'invoice_date': 發票日期，格式為 'YYYY-MM-DD'。民國年請轉換成西元年，找不到日期則為 null。",
+        "- 'items': 所有消費品項。『數量』沒有明確標示時預設為 1；依品項名稱判斷「類別」，例如：餐飲食品, 生活用品, 電腦/電子產品, 交通, 其他。",
+        "- 多行的品項名稱請合併成一個字串，金額為 0 的品項請忽略。",
     ]
+    for index, raw_text in enumerate(raw_texts):
+        prompt_parts += ["---", f"發票編號 {index}:", "```text", raw_text, "```"]
     prompt = "\n".join(prompt_parts)
+    response = model.generate_content(prompt)
+    raw_response = None
     try:
-        response = model.generate_content(prompt)
-        cleaned_response = re.sub(r'```json\n?|```', '', response.text.strip())
-        return json.loads(cleaned_response)
+        raw_response = response.text
+        receipts = json.loads(raw_response).get("receipts", [])
     except Exception as e:
-        st.error(f"AI 解析時發生錯誤: {e}")
-        try:
-            st.text_area("AI 原始回傳內容", response.text)
-        except:
-            pass
-        return None
+        # 這裡在快取函式中執行，不直接顯示 UI，交由頁面顯示錯誤與原始回傳內容
+        raise GeminiParseError(f"AI 解析時發生錯誤: {e}", raw_response) from e
+    return sorted(receipts, key=lambda receipt: receipt.get("receipt_index", 0))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _parse_bytes(image_contents):
+    """(速度優化) 以圖片內容為快取鍵，同一批發票重複辨識時直接回傳上次的結果"""
+    vision_client = get_vision_client()
+    ocr_contents = [prepare_image_for_ocr(content) for content in image_contents]
+    raw_texts = analyze_invoices_with_vision(vision_client, ocr_contents)
+    receipts = []
+    for start in range(0, len(raw_texts), GEMINI_BATCH_SIZE):
+        # 失敗時 parse_with_gemini 會拋出例外，不會把失敗結果快取起來
+        receipts += parse_with_gemini(raw_texts[start:start + GEMINI_BATCH_SIZE])
+    return receipts
 
 # --- 3. 使用者認證相關函式 (含頭像) ---
 
-def hash_password(password):
-    """將密碼進行 SHA-256 加密"""
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def crop_to_square(image: Image.Image):
-    """將 PIL 圖片從中心裁切成正方形"""
-    width, height = image.size
-    new_size = min(width, height)
-    left = (width - new_size)/2
-    top = (height - new_size)/2
-    right = (width + new_size)/2
-    bottom = (height + new_size)/2
-    return image.crop((left, top, right, bottom))
-
-def get_users_worksheet(sheet):
-    """獲取或建立使用者資料工作表，並確保頭像欄位存在"""
+def hash_password(password, salt=None):
+    """使用 scrypt 加鹽雜湊密碼，回傳 'salt$hash' 格式的十六進位字串"""
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1, dklen=32)
+    return f"{salt.hex()}${digest.hex()}"
+
+def is_legacy_hash(stored_hash):
+    """舊版帳號的密碼是未加鹽的 SHA-256，沒有 'salt$' 前綴"""
+    return '$' not in str(stored_hash)
+
+def verify_password(password, stored_hash):
+    """以固定時間比對驗證密碼，同時支援舊版 SHA-256 雜湊"""
+    stored_hash = str(stored_hash)
+    if is_legacy_hash(stored_hash):
+        candidate = hashlib.sha256(password.encode()).hexdigest()
+    else:
+        try:
+            salt = bytes.fromhex(stored_hash.split('$', 1)[0])
+        except ValueError:
+            return False
+        candidate = hash_password(password, salt)
+    return hmac.compare_digest(candidate, stored_hash)
+
+def encode_avatar(avatar_file):
+    """將上傳的頭像裁成 150x150 正方形，並編碼成 JPEG base64 字串"""
+    img = Image.open(avatar_file)
+    # ImageOps.fit 一次完成置中裁切與縮放，不會產生原尺寸的正方形中間圖
+    img_square = ImageOps.fit(img, (150, 150), method=Image.Resampling.BILINEAR)
+    if img_square.mode in ("RGBA", "LA", "P"):
+        # JPEG 不支援透明度，透明背景改鋪白色
+        img_rgba = img_square.convert("RGBA")
+        img_square = Image.new("RGB", img_rgba.size, "white")
+        img_square.paste(img_rgba, mask=img_rgba.getchannel("A"))
+    else:
+        img_square = img_square.convert("RGB")
+    with BytesIO() as buffered:
+        # 頭像存在單一儲存格中 (上限 50,000 字元)；照片存成 PNG 常會超過，JPEG 只需數千字元
+        img_square.save(buffered, format="JPEG", quality=85)
+        with buffered.getbuffer() as jpeg_view:
+            return base64.b64encode(jpeg_view).decode('ascii')
+
+def records_from_values(values):
+    """將工作表的原始儲存格值 (第一列為標題) 轉成字典列表"""
+    if not values:
+        return []
+    header = values[0]
+    records = []
+    for row in values[1:]:
+        if not any(row):
+            continue
+        padded = list(row) + [''] * (len(header) - len(row))
+        records.append(dict(zip(header, padded)))
+    return records
+
+@st.cache_resource
+def get_users_worksheet(_sheet):
+    """獲取或建立使用者資料工作表，並確保頭像欄位存在 (每個行程只檢查一次)"""
     try:
-        worksheet = sheet.worksheet("Users")
+        worksheet = _sheet.worksheet("Users")
         header = worksheet.row_values(1)
         if 'avatar_base64' not in header:
             worksheet.update_cell(1, len(header) + 1, 'avatar_base64')
         return worksheet
     except gspread.WorksheetNotFound:
-        worksheet = sheet.add_worksheet(title="Users", rows="100", cols="3")
+        worksheet = _sheet.add_worksheet(title="Users", rows="100", cols="3")
         worksheet.update('A1:C1', [['username', 'hashed_password', 'avatar_base64']])
         return worksheet
 
+@st.cache_data(ttl=30)
+def _users_snapshot():
+    """(速度優化) 一次讀取整個 Users 工作表，並在本地端解析成字典列表"""
+    sheet = get_google_sheet(GOOGLE_SHEET_NAME)
+    if not sheet: return []
+    users_ws = get_users_worksheet(sheet)
+    return records_from_values(users_ws.get('A1:C10000'))
+
 def check_login(username, password):
     """檢查登入資訊"""
     sheet = get_google_sheet(GOOGLE_SHEET_NAME)
-    if not sheet: return False
-    users_ws = get_users_worksheet(sheet)
-    users = users_ws.get_all_records()
-    hashed_password_to_check = hash_password(password)
+    if not sheet: return False, None
+    username_lower = username.lower()
+    users = _users_snapshot()
     for user in users:
-        if str(user.get('username')).lower() == username.lower() and user.get('hashed_password') == hashed_password_to_check:
-            return True, user.get('username')
+        if str(user.get('username')).lower() != username_lower:
+            continue
+        # 使用者名稱不分大小寫且唯一，只對這一筆計算 scrypt，比對完即結束
+        stored_hash = user.get('hashed_password')
+        if not verify_password(password, stored_hash):
+            return False, None
+        if is_legacy_hash(stored_hash):
+            # 舊版雜湊在登入成功時順便升級成 scrypt
+            update_user(user.get('username'), new_password=password)
+        return True, user.get('username')
     return False, None
 
 def add_user(username, password, avatar_file):
@@ -152,7 +279,7 @@ def add_user(username, password, avatar_file):
         return False, "資料庫連線失敗"
         
     users_ws = get_users_worksheet(sheet)
-    users = users_ws.get_all_records()
+    users = _users_snapshot()
     
     if username.lower() == ADMIN_USERNAME.lower():
         return False, "這個使用者名稱為管理員保留，請選擇其他名稱。"
@@ -162,19 +289,23 @@ def add_user(username, password, avatar_file):
     avatar_base64 = ""
     if avatar_file is not None:
         try:
-            img = Image.open(avatar_file)
-            img_square = crop_to_square(img)
-            img_square.thumbnail((150, 150))
-            buffered = BytesIO()
-            img_square.save(buffered, format="PNG")
-            avatar_base64 = base64.b64encode(buffered.getvalue()).decode()
+            avatar_base64 = encode_avatar(avatar_file)
         except Exception as e:
             st.warning(f"頭像處理失敗: {e}")
 
     hashed_password = hash_password(password)
     users_ws.append_row([username, hashed_password, avatar_base64])
+    _users_snapshot.clear()
     return True, "註冊成功！現在您可以用新帳號登入。"
 
+def find_user_row(users_ws, username):
+    """只讀取帳號欄並在本地端比對 (不分大小寫)，回傳使用者所在的列號，找不到則回傳 None"""
+    usernames_lower = [str(value).lower() for value in users_ws.col_values(1)[1:]]
+    try:
+        return usernames_lower.index(username.lower()) + 2
+    except ValueError:
+        return None
+
 def update_user(username, new_password=None, new_avatar_file=None):
     """更新使用者資料，包含密碼和頭像"""
     sheet = get_google_sheet(GOOGLE_SHEET_NAME)
@@ -183,21 +314,13 @@ def update_user(username, new_password=None, new_avatar_file=None):
     
     users_ws = get_users_worksheet(sheet)
     
-    try:
-        cell = users_ws.find(username)
-    except gspread.exceptions.CellNotFound:
+    row_index = find_user_row(users_ws, username)
+    if row_index is None:
         return False, "找不到該使用者"
-
-    row_index = cell.row
     
     if new_avatar_file is not None:
         try:
-            img = Image.open(new_avatar_file)
-            img_square = crop_to_square(img)
-            img_square.thumbnail((150, 150))
-            buffered = BytesIO()
-            img_square.save(buffered, format="PNG")
-            avatar_base64 = base64.b64encode(buffered.getvalue()).decode()
+            avatar_base64 = encode_avatar(new_avatar_file)
             users_ws.update_cell(row_index, 3, avatar_base64)
         except Exception as e:
             return False, f"頭像更新失敗: {e}"
@@ -205,9 +328,20 @@ def update_user(username, new_password=None, new_avatar_file=None):
     if new_password:
         hashed_password = hash_password(new_password)
         users_ws.update_cell(row_index, 2, hashed_password)
-        
+
+    _users_snapshot.clear()
     return True, "帳戶資料更新成功！"
 
+def group_contiguous_rows(row_numbers):
+    """將列號合併成連續範圍，例如 [2, 3, 4, 7] -> [(2, 4), (7, 7)]"""
+    row_ranges = []
+    for row in sorted(set(row_numbers)):
+        if row_ranges and row == row_ranges[-1][1] + 1:
+            row_ranges[-1] = (row_ranges[-1][0], row)
+        else:
+            row_ranges.append((row, row))
+    return row_ranges
+
 def delete_user(username_to_delete):
     """刪除使用者及其所有相關資料"""
     sheet = get_google_sheet(GOOGLE_SHEET_NAME)
@@ -216,30 +350,30 @@ def delete_user(username_to_delete):
 
     users_ws = get_users_worksheet(sheet)
     try:
-        cell = users_ws.find(username_to_delete)
-        users_ws.delete_rows(cell.row)
-    except gspread.exceptions.CellNotFound:
-        return False, "在使用者列表中找不到該使用者"
+        row_index = find_user_row(users_ws, username_to_delete)
+        if row_index is None:
+            return False, "在使用者列表中找不到該使用者"
+        users_ws.delete_rows(row_index)
+        _users_snapshot.clear()
     except Exception as e:
         return False, f"刪除使用者時發生錯誤: {e}"
 
     try:
         data_ws = sheet.worksheet("工作表1")
-        all_data = data_ws.get_all_records()
-        if all_data:
-            df = pd.DataFrame(all_data)
-            df_remaining = df[df['使用者'] != username_to_delete]
-            data_ws.clear()
-            if not df_remaining.empty:
-                data_ws.update([df_remaining.columns.values.tolist()] + df_remaining.values.tolist(), 'A1')
-            else:
-                try:
-                    header = df.columns.values.tolist()
-                    data_ws.update([header], 'A1')
-                except Exception:
-                    pass
-
-
+        header = data_ws.row_values(1)
+        if header and '使用者' not in header:
+            return False, "消費紀錄工作表缺少「使用者」欄位，無法刪除該使用者的資料"
+        if header:
+            cells = data_ws.findall(username_to_delete, in_column=header.index('使用者') + 1)
+            row_ranges = group_contiguous_rows([cell.row for cell in cells if cell.row > 1])
+            if row_ranges:
+                # 由下往上刪除，避免前面的刪除影響後面範圍的列號；所有範圍在同一個請求中完成
+                requests = [{
+                    "deleteDimension": {
+                        "range": {"sheetId": data_ws.id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end}
+                    }
+                } for start, end in reversed(row_ranges)]
+                sheet.batch_update({"requests": requests})
     except gspread.WorksheetNotFound:
         pass
     except Exception as e:
@@ -248,56 +382,149 @@ def delete_user(username_to_delete):
     return True, f"已成功刪除使用者「{username_to_delete}」及其所有資料。"
 
 
-@st.cache_data(ttl=60)
 def get_all_users():
-    """獲取所有使用者資料"""
+    """獲取所有使用者資料 (快取由 _users_snapshot 負責，寫入後清除即可立即更新)"""
+    return _users_snapshot()
+
+def fetch_user_rows(worksheet, header, username):
+    """只下載指定使用者的資料列：先讀取使用者欄找出列號，再用一次 batch_get 取回這些範圍"""
+    user_col = header.index('使用者') + 1
+    user_index = user_col - 1
+    row_numbers = [row for row, value in enumerate(worksheet.col_values(user_col), start=1) if row > 1 and value == username]
+    if not row_numbers:
+        return []
+    row_ranges = group_contiguous_rows(row_numbers)
+    if len(row_ranges) > MAX_BATCH_GET_RANGES:
+        # 資料列過於分散時，範圍清單會太長，改為整張讀取後在本地端篩選
+        return [row for row in worksheet.get_all_values()[1:] if len(row) > user_index and row[user_index] == username]
+    last_col = gspread.utils.rowcol_to_a1(1, len(header)).rstrip('0123456789')
+    value_ranges = worksheet.batch_get([f"A{start}:{last_col}{end}" for start, end in row_ranges])
+    # 兩次讀取之間若有其他使用者的列被刪除，列號會位移，因此取回後再依使用者欄篩選一次
+    return [row for value_range in value_ranges for row in value_range if len(row) > user_index and row[user_index] == username]
+
+@st.cache_data(ttl=600)
+def load_data(username):
+    """讀取並清理指定使用者的消費紀錄，回傳 (DataFrame, 被移除的重複筆數)"""
     sheet = get_google_sheet(GOOGLE_SHEET_NAME)
-    if not sheet: return []
-    users_ws = get_users_worksheet(sheet)
-    return users_ws.get_all_records()
+    if sheet:
+        try:
+            worksheet = sheet.worksheet("工作表1")
+            header = worksheet.row_values(1)
+            required_cols = ['日期', '品項', '數量', '金額', '使用者']
+            if not header: return pd.DataFrame(), 0
+            if not all(col in header for col in required_cols):
+                st.warning(f"工作表缺少必要的欄位 ({', '.join(required_cols)})，無法進行分析。")
+                return pd.DataFrame(), 0
+            data = records_from_values([header] + fetch_user_rows(worksheet, header, username))
+            if not data: return pd.DataFrame(), 0
+            df = pd.DataFrame(data)
+            original_rows = len(df)
+            df['金額'] = pd.to_numeric(df['金額'], errors='coerce')
+            df['數量'] = pd.to_numeric(df['數量'], errors='coerce')
+            # 先用固定格式走快速路徑；Sheets 以顯示格式 (如 2024/1/5) 回傳的日期再用推斷格式向量化解析，
+            # 只有仍然解析不了的零星資料才交給逐筆判斷的 format='mixed'
+            dates = pd.to_datetime(df['日期'], format='%Y-%m-%d', errors='coerce')
+            unparsed = dates.isna() & df['日期'].astype(bool)
+            if unparsed.any():
+                dates = dates.combine_first(pd.to_datetime(df.loc[unparsed, '日期'], errors='coerce'))
+                unparsed = dates.isna() & df['日期'].astype(bool)
+                if unparsed.any():
+                    dates = dates.combine_first(pd.to_datetime(df.loc[unparsed, '日期'], errors='coerce', format='mixed'))
+            df['日期'] = dates
+            # pyarrow 已隨 Streamlit 安裝，Arrow 字串欄位讓關鍵字搜尋走向量化的 C++ 實作
+            df['品項'] = df['品項'].astype('string[pyarrow]')
+            df.dropna(subset=required_cols, inplace=True)
+            df.drop_duplicates(subset=required_cols, keep='first', inplace=True)
+            deduplicated_rows = original_rows - len(df)
+            return df, deduplicated_rows
+        except gspread.WorksheetNotFound:
+            st.warning("找不到名為「工作表1」的分頁，請確認您的 Google Sheet。")
+            return pd.DataFrame(), 0
+    return pd.DataFrame(), 0
+
+@st.cache_data(ttl=300)
+def _decoded_avatar(username, avatar_base64):
+    """(速度優化) 快取解碼後的頭像，避免每次重新執行都要解碼所有使用者的頭像；資料損毀時回傳 None"""
+    if not avatar_base64:
+        return None
+    try:
+        img_data = base64.b64decode(avatar_base64)
+        Image.open(BytesIO(img_data)).verify()
+        return img_data
+    except Exception:
+        return None
 
 # --- 4. 頁面函式 ---
 def page_invoice_processing(username):
     st.title(f"🧠 {username} 的 AI 發票辨識")
-    st.info("您可以直接用相機拍照，或上傳現有圖片，AI 將自動為您解析。")
+    st.info("您可以直接用相機拍照，或一次上傳多張發票圖片，AI 將自動為您解析。")
     if 'parsed_df' not in st.session_state: st.session_state.parsed_df = None
-    if 'uploaded_file_content' not in st.session_state: st.session_state.uploaded_file_content = None
-    if 'uploaded_file_name' not in st.session_state: st.session_state.uploaded_file_name = None
+    if 'uploaded_file_contents' not in st.session_state: st.session_state.uploaded_file_contents = None
+    if 'uploaded_file_names' not in st.session_state: st.session_state.uploaded_file_names = None
+    if 'uploaded_previews' not in st.session_state: st.session_state.uploaded_previews = None
     if 'uploader_key' not in st.session_state: st.session_state.uploader_key = 0
     tab1, tab2 = st.tabs(["📷 拍照上傳", "📂 檔案上傳"])
     with tab1: camera_input = st.camera_input("點擊按鈕開啟相機拍攝發票", key=f"camera_{st.session_state.uploader_key}")
-    with tab2: file_uploader_input = st.file_uploader("從手機或電腦選擇圖片檔案", type=["png", "jpg", "jpeg"], key=f"uploader_{st.session_state.uploader_key}")
-    uploaded_file = camera_input or file_uploader_input
-    if uploaded_file is not None:
+    with tab2: file_uploader_input = st.file_uploader("從手機或電腦選擇圖片檔案 (可多選)", type=["png", "jpg", "jpeg"], accept_multiple_files=True, key=f"uploader_{st.session_state.uploader_key}")
+    uploaded_files = [camera_input] if camera_input is not None else (file_uploader_input or [])
+    if uploaded_files:
         col1, col2 = st.columns([2, 3])
         with col1:
-            if getattr(st.session_state, 'uploaded_file_name', None) != uploaded_file.name:
+            uploaded_file_names = [uploaded_file.name for uploaded_file in uploaded_files]
+            if st.session_state.uploaded_file_names != uploaded_file_names:
                 st.session_state.parsed_df = None
-                st.session_state.uploaded_file_name = uploaded_file.name
-                st.session_state.uploaded_file_content = uploaded_file.getvalue()
-            image = Image.open(uploaded_file)
-            st.image(image, caption="您上傳的圖片", use_container_width=True)
+                uploaded_file_contents = tuple(uploaded_file.getvalue() for uploaded_file in uploaded_files)
+                # 只在換檔時解碼一次並產生預覽；解碼後的大圖不保留在 session 中，辨識時再從原始內容解碼
+                uploaded_previews = []
+                for name, content in zip(uploaded_file_names, uploaded_file_contents):
+                    try:
+                        uploaded_previews.append(make_preview(Image.open(BytesIO(content))))
+                    except Exception as e:
+                        st.error(f"無法讀取圖片「{name}」，請確認檔案沒有損毀且為支援的格式。錯誤訊息: {e}")
+                        uploaded_previews = None
+                        break
+                # 預覽全部成功後才一起更新，避免檔名、內容與預覽彼此不一致
+                if uploaded_previews is None:
+                    uploaded_file_names = uploaded_file_contents = None
+                st.session_state.uploaded_file_names = uploaded_file_names
+                st.session_state.uploaded_file_contents = uploaded_file_contents
+                st.session_state.uploaded_previews = uploaded_previews
+            if st.session_state.uploaded_previews:
+                for name, preview in zip(st.session_state.uploaded_file_names, st.session_state.uploaded_previews):
+                    st.image(preview, caption=f"您上傳的圖片：{name}", use_container_width=True)
         with col2:
             if st.button("1. 開始辨識", type="primary", use_container_width=True):
-                if st.session_state.uploaded_file_content:
+                if st.session_state.uploaded_file_contents:
                     with st.spinner("AI 正在解析您的發票..."):
-                        vision_client = get_vision_client()
-                        if vision_client:
-                            raw_text = analyze_invoice_with_vision(vision_client, st.session_state.uploaded_file_content)
-                            parsed_data = parse_with_gemini(raw_text)
-                        else:
-                            parsed_data = None
-
-                        if not parsed_data or not isinstance(parsed_data, dict) or "items" not in parsed_data or not parsed_data.get("items"):
+                        try:
+                            # 所有發票一次送出：Vision 批次 OCR 加上單一 Gemini 請求
+                            receipts = _parse_bytes(st.session_state.uploaded_file_contents)
+                        except GeminiParseError as e:
+                            st.error(str(e))
+                            if e.raw_response:
+                                st.text_area("AI 原始回傳內容", e.raw_response)
+                            receipts = None
+                        except Exception as e:
+                            st.error(f"發票辨識失敗: {e}")
+                            receipts = None
+                        if receipts is not None and len(receipts) != len(uploaded_files):
+                            st.warning(f"送出 {len(uploaded_files)} 張發票，AI 回傳了 {len(receipts)} 張的解析結果，請確認是否有遺漏的發票。")
+                        receipts = receipts or []
+
+                        today = datetime.now().strftime('%Y-%m-%d')
+                        parsed_items = []
+                        for receipt in receipts:
+                            if not isinstance(receipt, dict):
+                                continue
+                            invoice_date = receipt.get("invoice_date") or today
+                            parsed_items += [dict(item, 日期=invoice_date) for item in receipt.get("items") or []]
+
+                        if not parsed_items:
                             st.warning("AI 無法自動解析出任何品項。請手動新增資料。")
-                            invoice_date = datetime.now().strftime('%Y-%m-%d')
-                            df = pd.DataFrame([{'日期': invoice_date, '品項': '', '數量': 1, '類別': '其他', '金額': 0}])
+                            df = pd.DataFrame([{'日期': today, '品項': '', '數量': 1, '類別': '其他', '金額': 0}])
                         else:
-                            parsed_items = parsed_data.get("items", [])
-                            invoice_date = parsed_data.get("invoice_date") or datetime.now().strftime('%Y-%m-%d')
-                            st.success(f"AI 成功解析出 {len(parsed_items)} 個品項！請在下方表格中校正。")
+                            st.success(f"AI 成功從 {len(uploaded_files)} 張發票解析出 {len(parsed_items)} 個品項！請在下方表格中校正。")
                             df = pd.DataFrame(parsed_items)
-                            df['日期'] = invoice_date
                         st.session_state.parsed_df = df[['日期', '品項', '數量', '類別', '金額']]
             if st.session_state.parsed_df is not None:
                 st.subheader("2. 校正辨識結果")
@@ -320,15 +547,20 @@ def page_invoice_processing(username):
                                     if sheet:
                                         worksheet_daily = sheet.worksheet("工作表1")
                                         header_daily = worksheet_daily.row_values(1)
+                                        rows_to_save = final_df_to_save.to_numpy(dtype=object).tolist()
                                         if not header_daily or '使用者' not in header_daily:
-                                            worksheet_daily.clear()
-                                            worksheet_daily.update([final_df_to_save.columns.values.tolist()] + final_df_to_save.values.tolist(), 'A1')
+                                            # 空白工作表直接一次寫入標題與資料；只有舊格式的工作表才需要先清空
+                                            if header_daily:
+                                                worksheet_daily.clear()
+                                            end_cell = gspread.utils.rowcol_to_a1(len(rows_to_save) + 1, len(final_df_to_save.columns))
+                                            worksheet_daily.update([final_df_to_save.columns.tolist()] + rows_to_save, f'A1:{end_cell}', value_input_option='USER_ENTERED')
                                         else:
-                                            worksheet_daily.append_rows(final_df_to_save.values.tolist(), value_input_option='USER_ENTERED')
+                                            worksheet_daily.append_rows(rows_to_save, value_input_option='USER_ENTERED')
+                                        load_data.clear()
                                         st.success("資料已成功寫入您的記帳本！")
                                         st.balloons()
                                         st.session_state.uploader_key += 1
-                                        st.session_state.parsed_df = None; st.session_state.uploaded_file_name = None; st.session_state.uploaded_file_content = None
+                                        st.session_state.parsed_df = None; st.session_state.uploaded_file_names = None; st.session_state.uploaded_file_contents = None; st.session_state.uploaded_previews = None
                                         st.rerun()
                                 else: st.warning("校正後的資料無效或不完整，無法儲存。")
                             except Exception as e: st.error(f"儲存過程中發生錯誤：{e}")
@@ -338,74 +570,51 @@ def page_invoice_processing(username):
 
 def page_dashboard(username):
     st.title(f"📊 {username} 的消費儀表板")
-    @st.cache_data(ttl=600)
-    def load_data():
-        sheet = get_google_sheet(GOOGLE_SHEET_NAME)
-        if sheet:
-            try:
-                worksheet = sheet.worksheet("工作表1")
-                data = worksheet.get_all_records()
-                if not data: return pd.DataFrame(), 0
-                df = pd.DataFrame(data)
-                required_cols = ['日期', '品項', '數量', '金額', '使用者']
-                if not all(col in df.columns for col in required_cols):
-                    st.warning(f"工作表缺少必要的欄位 ({', '.join(required_cols)})，無法進行分析。")
-                    return pd.DataFrame(), 0
-                original_rows = len(df)
-                df['金額'] = pd.to_numeric(df['金額'], errors='coerce')
-                df['數量'] = pd.to_numeric(df['數量'], errors='coerce')
-                df['日期'] = pd.to_datetime(df['日期'], errors='coerce')
-                df.dropna(subset=required_cols, inplace=True)
-                df.drop_duplicates(subset=required_cols, keep='first', inplace=True)
-                deduplicated_rows = original_rows - len(df)
-                return df, deduplicated_rows
-            except gspread.WorksheetNotFound:
-                st.warning("找不到名為「工作表1」的分頁，請確認您的 Google Sheet。")
-                return pd.DataFrame(), 0
-        return pd.DataFrame(), 0
-    df_all, removed_count = load_data()
-    if df_all.empty:
-        st.warning("您的記帳本中尚無有效資料，請先去『發票辨識』頁面上傳資料。")
-        return
-    df = df_all[df_all['使用者'] == username].copy()
+    df, removed_count = load_data(username)
     if df.empty:
         st.info(f"Hi {username}！您的專屬帳本中還沒有資料，快去上傳第一張發票吧！")
         return
-    if removed_count > 0: st.success(f"💡 為了數據準確，系統已自動為所有使用者過濾掉 {removed_count} 筆重複的消費紀錄。")
+    df = df.copy()
+    if removed_count > 0: st.success(f"💡 為了數據準確，系統已自動為您過濾掉 {removed_count} 筆重複的消費紀錄。")
     st.header("🔍 商品搜尋")
     search_term = st.text_input("輸入商品關鍵字來篩選您的消費紀錄：", placeholder="例如：牛奶、咖啡...")
     if search_term:
-        df = df[df['品項'].str.contains(search_term, case=False, na=False)]
+        df = df[df['品項'].str.contains(search_term, case=False, regex=False, na=False)]
         if df.empty:
             st.info(f"找不到您包含「{search_term}」的消費紀錄。")
             return
     try:
-        df['月份'] = df['日期'].dt.to_period('M').astype(str)
+        df['月份'] = df['日期'].values.astype('datetime64[M]')
+        # 只做一次 (月份, 類別) 分組，每月總額與各月類別佔比都從這張樞紐表取得
+        month_category = df.groupby(['月份', '類別'])['金額'].sum().unstack(fill_value=0)
     except Exception as e:
         st.error(f"資料格式錯誤，無法進行分析。錯誤訊息: {e}")
         st.dataframe(df)
         return
     st.header("消費總覽")
     total_expense = df['金額'].sum()
-    monthly_total = df.groupby('月份')['金額'].sum()
+    monthly_total = month_category.sum(axis=1)
+    month_labels = monthly_total.index.strftime('%Y-%m')
     monthly_avg = monthly_total.mean() if not monthly_total.empty else 0
     col1, col2 = st.columns(2)
     col1.metric("總支出金額", f"NT$ {int(total_expense):,}")
     col2.metric("平均每月支出", f"NT$ {int(monthly_avg):,}")
     st.subheader("每月消費趨勢")
-    monthly_summary = monthly_total.reset_index()
+    monthly_summary = pd.DataFrame({'月份': month_labels, '金額': monthly_total.values})
     fig_bar = px.bar(monthly_summary, x='月份', y='金額', title="每月總支出長條圖", text_auto='.2s', labels={'月份': '月份', '金額': '總金額 (NT$)'})
     fig_bar.update_traces(textangle=0, textposition="outside")
     st.plotly_chart(fig_bar, use_container_width=True)
     st.subheader("消費類別分析")
-    unique_months = sorted(df['月份'].unique(), reverse=True)
+    unique_months = list(month_labels[::-1])
     if not unique_months:
         st.info("目前篩選的範圍內沒有可分析的月份。")
         return
     selected_month = st.selectbox("請選擇要分析的月份：", unique_months)
     if selected_month:
-        month_df = df[df['月份'] == selected_month]
-        category_summary = month_df.groupby('類別')['金額'].sum().reset_index()
+        month_start = pd.Timestamp(selected_month)
+        month_df = df[df['月份'] == month_start]
+        month_categories = month_category.loc[month_start]
+        category_summary = month_categories[month_categories != 0].rename_axis('類別').reset_index(name='金額')
         if not category_summary.empty:
             fig_pie = px.pie(category_summary, names='類別', values='金額', title=f"{selected_month} 月份消費佔比", hole=0.3)
             fig_pie.update_traces(textinfo='percent+label', pull=[0.05] * len(category_summary))
@@ -520,15 +729,8 @@ if not st.session_state.logged_in:
     
     for i, user in enumerate(users):
         with cols[i % num_columns]:
-            avatar_data = user.get('avatar_base64', '')
-            if avatar_data:
-                try:
-                    img_data = base64.b64decode(avatar_data)
-                    st.image(img_data, width=150)
-                except:
-                    st.image("https://placehold.co/150x150/4A4A4A/FFFFFF?text=👤", width=150)
-            else:
-                st.image("https://placehold.co/150x150/4A4A4A/FFFFFF?text=👤", width=150)
+            img_data = _decoded_avatar(str(user.get('username', '')), user.get('avatar_base64', ''))
+            st.image(img_data or AVATAR_PLACEHOLDER_URL, width=150)
             
             if st.button(str(user.get('username', '')), key=f"user_{user.get('username', i)}", use_container_width=True):
                 st.session_state.selected_user = user.get('username')